@@ -1,14 +1,23 @@
 import os
+import io
 import requests
 import csv
+import orjson
 import time
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from functools import lru_cache
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sqlalchemy import (
     create_engine, Column, Integer, String, Float, Text, Date,
-    ForeignKey, Table
+    ForeignKey, Table, Index
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import declarative_base, relationship
 
 # =====================================
 # ENV
@@ -30,8 +39,12 @@ DATABASE_URL = (
 # DB
 # =====================================
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+engine = create_engine(
+    DATABASE_URL,
+    executemany_mode="values_plus_batch",
+    insertmanyvalues_page_size=1000,
+    executemany_batch_page_size=200
+)
 
 # =====================================
 # ASSOCIATION
@@ -57,6 +70,11 @@ class Movie(Base):
     vote_count = Column(Integer)
     popularity = Column(Float)
 
+    __table_args__ = (
+        Index("ix_movies_popularity", popularity.desc()),
+        Index("ix_movies_release_date", release_date),
+    )
+
     genres = relationship(
         "Genre",
         secondary=movies_genres_table,
@@ -79,10 +97,14 @@ class Genre(Base):
 # =====================================
 # HELPERS
 # =====================================
+@lru_cache(maxsize=4096)
 def parse_date_safe(date_str):
+    if not date_str:
+        return None
+
     try:
-        return datetime.strptime(date_str, "%Y-%m-%d").date()
-    except:
+        return date.fromisoformat(date_str)
+    except (TypeError, ValueError):
         return None
 
 # =====================================
@@ -92,142 +114,534 @@ http_session = requests.Session()
 http_session.headers.update({
     "Accept": "application/json"
 })
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=2,  # 3 attempts in all
+        backoff_factor=1,
+        backoff_max=8,
+        backoff_jitter=1,  # spread out 429 retries from parallel workers
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+))
+
+# =====================================
+# RATE LIMIT (TOKEN BUCKET)
+# =====================================
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.fill_rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                time.sleep((1 - self.tokens) / self.fill_rate)
+
+
+# TMDB allows ~40 requests per 10 seconds, bursts included
+rate_limiter = TokenBucket(40, 10)
 
 # =====================================
 # FETCH WITH RETRY + BACKOFF
 # =====================================
+TMDB_BASE_URL = "https://api.themoviedb.org/3"
+FETCH_WORKERS = 5
+
+
+def tmdb_get(path, **params):
+    rate_limiter.acquire()
+
+    response = http_session.get(
+        f"{TMDB_BASE_URL}{path}",
+        params={"api_key": TMDB_API_KEY, **params},
+        timeout=10
+    )
+    response.raise_for_status()
+
+    # Keep bad bodies (e.g. CDN error pages) on the skip path
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.RequestException(
+            f"Invalid JSON from {path}: {e}", response=response
+        ) from e
+
+
+def fetch_page(page):
+    print(f"Fetching Page {page}...")
+
+    try:
+        data = tmdb_get("/discover/movie", language="en-US", page=page)
+    except requests.RequestException as e:
+        print(f"Skipping page {page} after retries: {e}")
+        return None
+
+    return data.get("results", [])
+
+
 def fetch_movies_batch(start_page, pages_per_batch):
     movies = []
+    skipped = 0
+    pages = range(start_page, start_page + pages_per_batch)
 
-    for page in range(start_page, start_page + pages_per_batch):
-        retries = 3
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pages_results = list(executor.map(fetch_page, pages))
 
-        while retries > 0:
-            try:
-                print(f"Fetching Page {page}...")
+    for results in pages_results:
+        if results is None:
+            skipped += 1
+            continue
 
-                url = (
-                    f"https://api.themoviedb.org/3/discover/movie"
-                    f"?api_key={TMDB_API_KEY}&language=en-US&page={page}"
-                )
+        if not results:
+            break
+
+        movies.extend(results)
 
-                response = http_session.get(url, timeout=10)
+    return movies, skipped
 
-                if response.status_code != 200:
-                    raise Exception(f"HTTP {response.status_code}")
+# =====================================
+# FETCH CHANGES (INCREMENTAL)
+# =====================================
+def fetch_changed_ids(start_date):
+    ids = []
+    page = 1
+    total_pages = 1
+
+    while page <= total_pages:
+        print(f"Fetching Changes Page {page}...")
+
+        data = tmdb_get(
+            "/movie/changes",
+            start_date=start_date.isoformat(),
+            page=page
+        )
+        total_pages = data.get("total_pages", 1)
+
+        ids.extend(
+            r["id"] for r in data.get("results", [])
+            if not r.get("adult")
+        )
+        page += 1
 
-                data = response.json()
-                results = data.get("results", [])
+    return list(dict.fromkeys(ids))
 
-                if not results:
-                    return movies
 
-                movies.extend(results)
-                time.sleep(0.4)  # SAFE rate
-                break
+def fetch_movie(movie_id):
+    # None: fetch failed; {}: TMDB no longer has the movie
+    try:
+        data = tmdb_get(f"/movie/{movie_id}", language="en-US")
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            print(f"Movie {movie_id} deleted on TMDB")
+            return {}
+
+        print(f"Skipping movie {movie_id} after retries: {e}")
+        return None
+    except requests.RequestException as e:
+        print(f"Skipping movie {movie_id} after retries: {e}")
+        return None
 
-            except Exception as e:
-                retries -= 1
-                print(f"Retrying page {page} ({retries} left): {e}")
-                time.sleep(2)
+    # Details return genre objects; match the discover payload
+    data["genre_ids"] = [g["id"] for g in data.get("genres", [])]
+    return data
 
-        else:
-            print(f"Skipping page {page} after retries")
 
-    return movies
+def fetch_movies_by_id(movie_ids):
+    movies = []
+    skipped = 0
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for m in executor.map(fetch_movie, movie_ids):
+            if m is None:
+                skipped += 1
+            elif m:
+                movies.append(m)
+
+    return movies, skipped
 
 # =====================================
 # CSV (APPEND)
 # =====================================
-def save_to_csv(movies, filename="popular_movies.csv"):
-    file_exists = os.path.exists(filename)
+CSV_FILE = "popular_movies.csv"
+CSV_BUFFER_SIZE = 1 << 23  # 8 MB
+CSV_HEADER = [
+    "id", "title", "overview", "release_date",
+    "vote_average", "vote_count", "popularity", "genre_ids"
+]
 
-    with open(filename, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
 
-        if not file_exists:
-            writer.writerow([
-                "id", "title", "overview", "release_date",
-                "vote_average", "vote_count", "popularity", "genre_ids"
-            ])
+MOVIE_COLUMNS = CSV_HEADER[:-1]
 
-        for m in movies:
-            writer.writerow([
-                m.get("id"),
-                m.get("title"),
-                m.get("overview"),
-                m.get("release_date"),
-                m.get("vote_average"),
-                m.get("vote_count"),
-                m.get("popularity"),
-                ",".join(map(str, m.get("genre_ids", [])))
-            ])
+
+def open_csv(filename=CSV_FILE):
+    write_header = (
+        not os.path.exists(filename) or os.path.getsize(filename) == 0
+    )
+
+    f = open(
+        filename, "a", buffering=CSV_BUFFER_SIZE,
+        newline="", encoding="utf-8"
+    )
+
+    if write_header:
+        csv.writer(f).writerow(CSV_HEADER)
+
+    return f
+
+
+def serialize_batch(movies):
+    # One CSV pass feeds both the file and the COPY stream
+    buf = io.StringIO()
+    csv.writer(buf).writerows(
+        (
+            m.get("id"),
+            m.get("title"),
+            m.get("overview"),
+            parse_date_safe(m.get("release_date")),
+            m.get("vote_average"),
+            m.get("vote_count"),
+            m.get("popularity"),
+            ",".join(map(str, m.get("genre_ids", [])))
+        )
+        for m in movies
+    )
+    return buf.getvalue()
+
+
+def save_to_csv(f, payload):
+    f.write(payload)
+
+
+def rollback_csv(f, committed_pos):
+    # Drop rows written since the last DB commit, flushed or not
+    f.seek(committed_pos)
+    f.truncate()
 
 # =====================================
-# DB BATCH INSERT
+# DB BATCH INSERT (COPY + STAGING)
 # =====================================
-def save_batch_to_db(movies):
-    session = Session()
+def save_batch_to_db(conn, movies, payload, upsert=False):
+    gids = {g for m in movies for g in m.get("genre_ids", [])}
+    link_rows = [
+        (m["id"], gid)
+        for m in movies
+        for gid in m.get("genre_ids", [])
+    ]
+    columns = ",".join(MOVIE_COLUMNS)
+
+    if upsert:
+        on_conflict = "DO UPDATE SET " + ", ".join(
+            f"{c} = EXCLUDED.{c}" for c in MOVIE_COLUMNS[1:]
+        )
+    else:
+        on_conflict = "DO NOTHING"
 
-    genre_cache = {
-        g.genre_id: g
-        for g in session.query(Genre).all()
-    }
+    cur = conn.connection.cursor()
 
-    for m in movies:
-        if session.get(Movie, m["id"]):
-            continue
+    # Temp tables skip WAL; only the merged delta into movies is logged.
+    # The staging table lives until the run's transaction commits.
+    cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS movies_staging "
+        "(LIKE movies INCLUDING DEFAULTS, genre_ids TEXT) ON COMMIT DROP"
+    )
+    # csv.writer emits both "" and None as an empty unquoted field, which
+    # COPY reads as NULL; FORCE_NOT_NULL stores '' for either in the text
+    # columns. Other columns keep NULL.
+    cur.copy_expert(
+        f"COPY movies_staging ({','.join(CSV_HEADER)}) "
+        f"FROM STDIN WITH (FORMAT CSV, FORCE_NOT_NULL (title, overview))",
+        io.StringIO(payload)
+    )
+    cur.execute(
+        f"INSERT INTO movies ({columns}) "
+        f"SELECT DISTINCT ON (id) {columns} FROM movies_staging "
+        f"ON CONFLICT (id) {on_conflict}"
+    )
+    cur.execute("TRUNCATE movies_staging")
+
+    # No genre preload: unseen ids are resolved by ON CONFLICT
+    if gids:
+        conn.execute(
+            insert(Genre.__table__)
+            .values([
+                {"genre_id": gid, "genre_name": f"Genre {gid}"}
+                for gid in gids
+            ])
+            .on_conflict_do_nothing(index_elements=["genre_id"])
+        )
 
-        movie = Movie(
-            id=m["id"],
-            title=m.get("title"),
-            overview=m.get("overview"),
-            release_date=parse_date_safe(m.get("release_date")),
-            vote_average=m.get("vote_average"),
-            vote_count=m.get("vote_count"),
-            popularity=m.get("popularity")
+    # Refreshed movies get exactly their current genres
+    if upsert:
+        cur.execute(
+            "DELETE FROM movies_genres WHERE movie_id = ANY(%s)",
+            ([m["id"] for m in movies],)
         )
 
-        for gid in m.get("genre_ids", []):
-            if gid not in genre_cache:
-                genre_cache[gid] = Genre(
-                    genre_id=gid,
-                    genre_name=f"Genre {gid}"
-                )
-                session.add(genre_cache[gid])
+    if link_rows:
+        execute_values(
+            cur,
+            "INSERT INTO movies_genres (movie_id, genre_id) VALUES %s "
+            "ON CONFLICT DO NOTHING",
+            link_rows,
+            page_size=1000
+        )
+
+    cur.close()
+
+    print(f"{'Upserted' if upsert else 'Inserted'} {len(movies)} movies")
+
+# =====================================
+# CHECKPOINT
+# =====================================
+CHECKPOINT_FILE = "checkpoint.txt"
+
+
+# "<last committed page> <pages skipped so far>"
+def read_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE, encoding="utf-8") as f:
+            fields = f.read().split()
+
+        page = int(fields[0])
+        skipped = int(fields[1]) if len(fields) > 1 else 0
+        return page, skipped
+    except (FileNotFoundError, IndexError, ValueError):
+        return 0, 0
+
+
+def write_checkpoint(page, skipped):
+    with open(CHECKPOINT_FILE, "w", encoding="utf-8") as f:
+        f.write(f"{page} {skipped}")
 
-            movie.genres.append(genre_cache[gid])
 
-        session.add(movie)
+LAST_RUN_FILE = "last_run.txt"
+LAST_DISCOVER_FILE = "last_discover.txt"
 
-    session.commit()
-    session.close()
-    print(f"Inserted {len(movies)} movies")
+
+def read_run_date(filename):
+    try:
+        with open(filename, encoding="utf-8") as f:
+            return date.fromisoformat(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_run_date(filename, run_date):
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(run_date.isoformat())
 
 # =====================================
-# MAIN
+# SYNC
 # =====================================
-def main():
+def process_batch(csv_file, conn, batch, upsert=False):
+    # Re-ranking between page requests can return a movie twice
+    batch = list({m["id"]: m for m in batch}.values())
+    payload = serialize_batch(batch)
+    save_to_csv(csv_file, payload)
+    save_batch_to_db(conn, batch, payload, upsert)
+
+
+def sync_discover():
     MAX_PAGES = 100
     PAGES_PER_BATCH = 5
+    COMMIT_EVERY_BATCHES = 10
+
+    # Skips from the interrupted run carry over, so resuming cannot mark
+    # a crawl complete while an earlier page is still missing
+    last_page, skipped = read_checkpoint()
+    page = last_page + 1
+    resumed = page > 1
+
+    if resumed:
+        print(f"Resuming from page {page}")
+
+    batches = 0
+    loaded = 0
+    csv_file = open_csv()
+    committed_pos = csv_file.tell()
 
+    with csv_file, engine.connect() as conn:
+        trans = conn.begin()
+
+        try:
+            while page <= MAX_PAGES:
+                print(f"\nProcessing batch from page {page}")
+
+                batch, batch_skipped = fetch_movies_batch(
+                    page, PAGES_PER_BATCH
+                )
+                skipped += batch_skipped
+
+                if not batch:
+                    break
+
+                process_batch(csv_file, conn, batch)
+
+                page += PAGES_PER_BATCH
+                batches += 1
+                loaded += len(batch)
+
+                if batches % COMMIT_EVERY_BATCHES == 0:
+                    csv_file.flush()
+                    trans.commit()
+                    committed_pos = csv_file.tell()
+                    write_checkpoint(page - 1, skipped)
+                    trans = conn.begin()
+
+            csv_file.flush()
+            trans.commit()
+
+        # BaseException: Ctrl-C or a scheduler shutdown would otherwise
+        # flush the uncommitted rows when the file closes
+        except BaseException:
+            trans.rollback()
+            rollback_csv(csv_file, committed_pos)
+            print(
+                f"Rolled back, next run resumes after page "
+                f"{read_checkpoint()[0]}"
+            )
+            raise
+
+    # Skipped pages are only recovered by a fresh crawl from page 1
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+
+    complete = skipped == 0 and (loaded > 0 or resumed)
+
+    if not complete:
+        print(
+            f"Discover crawl incomplete: {loaded} movies loaded, "
+            f"{skipped} pages skipped"
+        )
+
+    return complete
+
+
+def sync_changes(start_date):
+    MOVIES_PER_BATCH = 100
+
+    print(f"Fetching changes since {start_date.isoformat()}")
+
+    movie_ids = fetch_changed_ids(start_date)
+    skipped = 0
+
+    csv_file = open_csv()
+
+    # Nothing is checkpointed: a failed run leaves last_run.txt untouched
+    # and the next run re-reads the same change window
+    with csv_file:
+        committed_pos = csv_file.tell()
+
+        try:
+            with engine.begin() as conn:
+                # /changes spans the whole catalogue; only refresh movies
+                # we already track. New popular titles come from discover.
+                stored_ids = set(conn.exec_driver_sql(
+                    "SELECT id FROM movies WHERE id = ANY(%s)",
+                    (movie_ids,)
+                ).scalars())
+                movie_ids = [i for i in movie_ids if i in stored_ids]
+                print(f"{len(movie_ids)} changed movies already stored")
+
+                for i in range(0, len(movie_ids), MOVIES_PER_BATCH):
+                    chunk = movie_ids[i:i + MOVIES_PER_BATCH]
+                    print(
+                        f"\nProcessing changed movies {i + 1}-{i + len(chunk)}"
+                    )
+
+                    batch, batch_skipped = fetch_movies_by_id(chunk)
+                    skipped += batch_skipped
+
+                    if batch:
+                        process_batch(csv_file, conn, batch, upsert=True)
+
+                csv_file.flush()
+
+        except BaseException:
+            rollback_csv(csv_file, committed_pos)
+            raise
+
+    if skipped:
+        print(f"Change sync incomplete: {skipped} movies skipped")
+
+    return skipped == 0
+
+# =====================================
+# INDEXES
+# =====================================
+def create_indexes():
+    # Built after the load commits; a no-op once they exist
+    with engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as conn:
+        for index in Movie.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+# =====================================
+# MAIN
+# =====================================
+CHANGES_MAX_DAYS = 14  # TMDB caps the /changes window
+DISCOVER_EVERY_DAYS = 7
+
+
+def main():
     print("Starting TMDB Batch Pipeline...")
     print(f"DB Connected: {DATABASE_URL}")
 
-    page = 1
+    run_date = datetime.now(timezone.utc).date()
+    last_run = read_run_date(LAST_RUN_FILE)
+    last_discover = read_run_date(LAST_DISCOVER_FILE)
 
-    while page <= MAX_PAGES:
-        print(f"\nProcessing batch from page {page}")
+    changes_available = (
+        last_run is not None
+        and (run_date - last_run).days <= CHANGES_MAX_DAYS
+    )
 
-        batch = fetch_movies_batch(page, PAGES_PER_BATCH)
+    synced = False
 
-        if not batch:
-            break
+    if changes_available:
+        synced = sync_changes(last_run)
+
+    # Discover picks up movies that became popular without being edited
+    if (
+        not changes_available
+        or last_discover is None
+        or (run_date - last_discover).days >= DISCOVER_EVERY_DAYS
+        or os.path.exists(CHECKPOINT_FILE)
+    ):
+        if sync_discover():
+            write_run_date(LAST_DISCOVER_FILE, run_date)
+
+            # A crawl is only a baseline when there was no change window;
+            # it inserts new movies but does not refresh stored ones
+            if not changes_available:
+                synced = True
+
+    create_indexes()
 
-        save_to_csv(batch)
-        save_batch_to_db(batch)
+    # Without a full baseline or a fully synced change window, leave
+    # last_run.txt alone so the next run covers the same window again
+    if not synced:
+        print("\nPipeline incomplete, run dates not advanced")
+        return
 
-        page += PAGES_PER_BATCH
+    write_run_date(LAST_RUN_FILE, run_date)
 
     print("\nPipeline completed successfully")
 